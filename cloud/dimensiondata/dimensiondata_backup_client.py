@@ -25,8 +25,10 @@ short_description: add/delete backup client for a host
 description:
     - Add or delete a backup client for a host in the Dimension Data Cloud
 notes:
-    - If given state = 'present' and backup client is found, it is not
-    changed/edited.
+    - If given state = 'present' and backup client is found, it is only
+      changed when service_plan is set and differs from the current plan.
+    - Servers in node_ids are processed concurrently when the
+      concurrent.futures module is available.
 version_added: "2.2"
 options:
   state:
@@ -63,11 +65,13 @@ options:
   schedule_policy:
     description:
       - The schedule policy for backups.
+      - Required when state is present.
     choices: [12AM - 6AM, 6AM - 12PM, 12PM - 6PM, 6PM - 12AM]
   storage_policy:
     description:
       - The storage policy for backups.
-    required: true
+      - Required when state is present.
+    required: false
     choices: ['14 Day Storage Policy', '30 Day Storage Policy',
               '60 Day Storage Policy', '90 Day Storage Policy',
               '180 Day Storage Policy', '1 Year Storage Policy',
@@ -83,6 +87,43 @@ options:
       - When to send an email to the notify_email.
     default: ON_FAILURE
     choices: [ON_FAILURE, ON_SUCCESS]
+  service_plan:
+    description:
+      - The service plan the backup target of an existing client should use.
+        If not set, the service plan of existing clients is left unchanged.
+      - Ignored for newly added clients.
+    required: false
+    default: null
+    choices: [Essentials, Advanced, Enterprise]
+  cache_dir:
+    description:
+      - Directory used to cache backup details between module runs.
+    required: false
+    default: ~/.ansible/tmp/dd_backup_cache
+  cache_ttl:
+    description:
+      - Number of seconds cached backup details stay valid.
+        Set to 0 to disable the cache.
+    required: false
+    default: 60
+  api_rate_limit:
+    description:
+      - Maximum number of API requests per second issued by this module.
+        The rate is halved each time the API reports rate limiting.
+        Set to 0 to disable client-side rate limiting.
+    required: false
+    default: 20
+  api_burst:
+    description:
+      - Number of API requests that may be issued in a burst before
+        api_rate_limit applies.
+    required: false
+    default: 40
+  batch_size:
+    description:
+      - Number of servers from node_ids processed concurrently per batch.
+    required: false
+    default: 50
 author:
     - "Jeff Dunham (@jadunham1)"
 '''
@@ -124,134 +165,507 @@ servers:
   contains: node_ids processed
 '''
 
-from ansible.module_utils.basic import *
-from ansible.module_utils.dimensiondata import *
+import fcntl
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
 try:
-    from libcloud.common.dimensiondata import DimensionDataAPIException
-    from libcloud.backup.drivers.dimensiondata import DimensionDataBackupDriver
-    import libcloud.security
-    HAS_LIBCLOUD = True
-except:
-    HAS_LIBCLOUD = False
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    HAS_FUTURES = True
+except ImportError:
+    HAS_FUTURES = False
 
-# Get regions early to use in docs etc.
-dd_regions = get_dd_regions()
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.dimensiondata import get_credentials, get_dd_regions
 
+# Upper bound on concurrent API requests issued for a single module run
+MAX_WORKERS = 16
 
-def get_backup_client(details, client_type):
-    if len(details.clients) > 0:
-        for client in details.clients:
-            if client.type.type == client_type:
-                return client
-    return None
+# Backoff settings for rate limited API calls
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+RATE_LIMIT_RE = re.compile(r'rate.?limit|too many requests|throttl', re.I)
+DAILY_LIMIT_RE = re.compile(r'daily|per day', re.I)
+# HTTP statuses libcloud reports as the error code for transient failures
+TRANSIENT_ERROR_CODES = ('500', '502', '503', '504')
 
+# Floor for the client-side API rate once the API starts rate limiting us
+MIN_API_RATE = 1.0
 
-def _backup_client_obj_to_dict(backup_client):
-    backup_client_dict = {}
-    backup_client_dict['id'] = backup_client.id
-    backup_client_dict['client_type'] = backup_client.type.type
-    backup_client_dict['storage_policy'] = backup_client.storage_policy
-    backup_client_dict['schedule_policy'] = backup_client.schedule_policy
-    backup_client_dict['download_url'] = backup_client.download_url
-    return backup_client_dict
+# time.monotonic is not available on Python 2
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Error code returned when a server has no backup target
+NOT_PROVISIONED_CODE = 'NO_BACKUP'
+
+
+# Placeholder until main() binds libcloud's exception class, so the except
+# clauses in the helpers are valid even if they run before that import.
+class DimensionDataAPIException(Exception):
+    pass
+
+
+# Get regions early to use in docs etc.
+dd_regions = get_dd_regions()
+
+_CLIENT_TYPES = ('FA.Win', 'FA.AD', 'FA.Linux', 'MySQL', 'PostgreSQL')
+_SCHEDULE_POLICIES = ('12AM - 6AM', '6AM - 12PM', '12PM - 6PM', '6PM - 12AM')
+_NOTIFY_TRIGGERS = ('ON_FAILURE', 'ON_SUCCESS')
+_SERVICE_PLANS = ('Essentials', 'Advanced', 'Enterprise')
+_STORAGE_POLICY_LENGTHS = ('14 Day', '30 Day', '60 Day', '90 Day',
+                           '180 Day', '1 Year', '2 Year', '3 Year',
+                           '4 Year', '5 Year', '6 Year', '7 Year')
+_STORAGE_POLICY_CHOICES = tuple(
+    "%s Storage Policy%s" % (length, suffix)
+    for length in _STORAGE_POLICY_LENGTHS
+    for suffix in ('', ' + Secondary Copy')
+)
+
+
+def get_backup_client(backup_details, client_type):
+    by_type = getattr(backup_details, '_by_type', None)
+    if by_type is None:
+        # Built in reverse so the first client of a given type wins,
+        # matching a front-to-back scan of the client list.
+        clients = backup_details.clients or []
+        by_type = dict((c.type.type, c) for c in reversed(clients))
+        backup_details._by_type = by_type
+    return by_type.get(client_type)
 
 
-def get_backup_details_for_host(module, client, server_id):
+def _backup_client_obj_to_dict(backup_client):
+    return {
+        'id': backup_client.id,
+        'client_type': backup_client.type.type,
+        'storage_policy': backup_client.storage_policy,
+        'schedule_policy': backup_client.schedule_policy,
+        'download_url': backup_client.download_url,
+    }
+
+
+class BackupClientError(Exception):
+    pass
+
+
+def _is_rate_limited(e):
+    return (str(getattr(e, 'code', '')) == '429' or
+            RATE_LIMIT_RE.search(str(e.msg or '')) is not None)
+
+
+def _is_transient_error(e):
+    return str(getattr(e, 'code', '')) in TRANSIENT_ERROR_CODES
+
+
+def _is_not_provisioned(e):
+    if getattr(e, 'code', None) == NOT_PROVISIONED_CODE:
+        return True
+    return bool(e.msg) and 'not been provisioned' in e.msg
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket limiting the rate of API requests.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = _monotonic()
+        self.throttled_at = None
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = _monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        with self.cond:
+            self._refill()
+            while self.tokens < 1:
+                self.cond.wait((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def throttle(self):
+        """
+        Halve the rate for the remainder of the run.
+
+        Only applies while the bucket is drained, and at most once per
+        refill interval so that simultaneous rate limit errors from several
+        workers count as one. Returns whether the rate was lowered.
+        """
+        with self.cond:
+            self._refill()
+            if self.tokens >= 1:
+                return False
+            if (self.throttled_at is not None and
+                    self.updated - self.throttled_at < 1 / self.rate):
+                return False
+            self.rate = min(self.rate, max(self.rate / 2, MIN_API_RATE))
+            self.throttled_at = self.updated
+            return True
+
+
+def _call_with_retry(client, fn, *args, **kwargs):
+    """
+    Call a libcloud driver method, backing off exponentially while the
+    API reports that we are being rate limited or fails with a transient
+    5xx error.
+
+    If the driver has a rate limiter attached, a token is taken before
+    every attempt and the rate is halved whenever the API still reports
+    rate limiting.
+    """
+    limiter = getattr(client, '_rate_limiter', None)
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except DimensionDataAPIException as e:
+            attempt += 1
+            rate_limited = _is_rate_limited(e)
+            if not rate_limited and not _is_transient_error(e):
+                raise
+            if rate_limited and limiter is not None:
+                limiter.throttle()
+            if attempt >= RETRY_ATTEMPTS:
+                raise
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+            if rate_limited and DAILY_LIMIT_RE.search(str(e.msg or '')):
+                delay *= 2
+            delay += random.uniform(0, RETRY_BASE_DELAY)
+            time.sleep(min(delay, RETRY_MAX_DELAY))
+
+
+def _backup_client_to_dict(c):
+    alert = running_job = None
+    if c.alert is not None:
+        alert = {
+            'trigger': c.alert.trigger,
+            'notify_list': c.alert.notify_list,
+        }
+    if c.running_job is not None:
+        running_job = {
+            'id': c.running_job.id,
+            'status': c.running_job.status,
+            'percentage': c.running_job.percentage,
+        }
+    return {
+        'id': c.id,
+        'type': {
+            'type': c.type.type,
+            'is_file_system': c.type.is_file_system,
+            'description': c.type.description,
+        },
+        'status': c.status,
+        'schedule_policy': c.schedule_policy,
+        'storage_policy': c.storage_policy,
+        'download_url': c.download_url,
+        'alert': alert,
+        'running_job': running_job,
+    }
+
+
+def _backup_details_to_dict(backup_details):
+    return {
+        'asset_id': backup_details.asset_id,
+        'service_plan': backup_details.service_plan,
+        'status': backup_details.status,
+        'clients': [_backup_client_to_dict(c)
+                    for c in backup_details.clients or []],
+    }
+
+
+def _backup_details_from_dict(details_dict):
+    from libcloud.common.dimensiondata import (
+        DimensionDataBackupClient, DimensionDataBackupClientAlert,
+        DimensionDataBackupClientRunningJob, DimensionDataBackupClientType,
+        DimensionDataBackupDetails)
+    clients = []
+    for c in details_dict['clients']:
+        alert = running_job = None
+        if c['alert'] is not None:
+            alert = DimensionDataBackupClientAlert(**c['alert'])
+        if c['running_job'] is not None:
+            running_job = DimensionDataBackupClientRunningJob(
+                **c['running_job'])
+        clients.append(DimensionDataBackupClient(
+            id=c['id'],
+            type=DimensionDataBackupClientType(**c['type']),
+            status=c['status'],
+            schedule_policy=c['schedule_policy'],
+            storage_policy=c['storage_policy'],
+            download_url=c['download_url'],
+            alert=alert,
+            running_job=running_job))
+    return DimensionDataBackupDetails(
+        asset_id=details_dict['asset_id'],
+        service_plan=details_dict['service_plan'],
+        status=details_dict['status'],
+        clients=clients)
+
+
+class BackupDetailsCache(object):
+    """
+    On-disk cache of backup details shared between module runs.
+
+    Entries are stored as JSON, including each client's alert and running
+    job, keyed by region, user and server id, and expire after ttl seconds.
+    A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, cache_dir, ttl, region, user_id):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        self.region = region
+        self.user_id = user_id
+
+    def _path(self, server_id):
+        key = '\0'.join((self.region, self.user_id, server_id))
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def get(self, server_id):
+        if self.ttl <= 0:
+            return None
+        try:
+            f = open(self._path(server_id), 'r')
+        except (IOError, OSError):
+            return None
+        try:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                entry = json.load(f)
+                if time.time() - entry['timestamp'] > self.ttl:
+                    return None
+                return _backup_details_from_dict(entry['backup_details'])
+            except Exception:
+                return None
+        finally:
+            f.close()
+
+    def set(self, server_id, backup_details):
+        if self.ttl <= 0:
+            return
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+        except OSError:
+            if not os.path.isdir(self.cache_dir):
+                return
+        try:
+            fd = os.open(self._path(server_id), os.O_WRONLY | os.O_CREAT,
+                         0o600)
+            f = os.fdopen(fd, 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.truncate()
+                json.dump({
+                    'timestamp': time.time(),
+                    'backup_details': _backup_details_to_dict(backup_details),
+                }, f)
+            finally:
+                f.close()
+        except Exception:
+            self.invalidate(server_id)
+
+    def invalidate(self, server_id):
+        try:
+            os.remove(self._path(server_id))
+        except OSError:
+            pass
+
+
+def _backup_details_cache(client):
+    # Per-run memo of backup details keyed by server id
+    return client.__dict__.setdefault('_bd_cache', {})
+
+
+def invalidate_backup_details(client, server_id):
+    _backup_details_cache(client).pop(server_id, None)
+    disk_cache = getattr(client, '_bd_disk_cache', None)
+    if disk_cache is not None:
+        disk_cache.invalidate(server_id)
+
+
+def get_backup_details_for_host(client, server_id):
+    cache = _backup_details_cache(client)
+    if server_id in cache:
+        return cache[server_id]
+    disk_cache = getattr(client, '_bd_disk_cache', None)
+    if disk_cache is not None:
+        backup_details = disk_cache.get(server_id)
+        if backup_details is not None:
+            cache[server_id] = backup_details
+            return backup_details
     try:
-        backup_details = client.ex_get_backup_details_for_target(server_id)
+        backup_details = _call_with_retry(
+            client, client.ex_get_backup_details_for_target, server_id)
     except DimensionDataAPIException as e:
-        if e.msg.endswith('has not been provisioned for backup'):
-            module.fail_json(msg="Server %s does not have backup enabled"
-                             % server_id)
+        if _is_not_provisioned(e):
+            raise BackupClientError("Server %s does not have backup enabled"
+                                    % server_id)
         else:
-            module.fail_json(msg="Problem finding backup info for host: %s"
-                             % e.msg)
+            raise BackupClientError("Problem finding backup info for host: "
+                                    "%s (code: %s)"
+                                    % (e.msg, getattr(e, 'code', None)))
+    cache[server_id] = backup_details
+    if disk_cache is not None:
+        disk_cache.set(server_id, backup_details)
     return backup_details
 
 
-def handle_backup_client(module, client):
+def _process_server(get_client, server_id, state, client_type, service_plan,
+                    add_args):
+    """
+    Bring the backup client of a single server into the requested state.
+
+    get_client returns the driver for the calling thread. Returns a tuple
+    of (server_id, changed, result, error) so that it can be run from a
+    worker thread without calling fail_json/exit_json.
+    """
     changed = False
-    state = module.params['state']
-    client_type = module.params['client_type']
-    server_clients_return = {}
+    result = None
 
-    for server_id in module.params['node_ids']:
-        backup_details = get_backup_details_for_host(module, client, server_id)
+    try:
+        client = get_client()
+        backup_details = get_backup_details_for_host(client, server_id)
         backup_client = get_backup_client(backup_details, client_type)
         if state == 'absent' and backup_client is None:
-            continue
+            pass
         elif state == 'absent' and backup_client is not None:
             changed = True
-            remove_client_from_server(client, module, server_id, backup_client)
+            remove_client_from_server(client, server_id, backup_client)
         elif state == 'present' and backup_client is None:
             changed = True
-            add_client_to_server(client, module, server_id)
-            backup_details = get_backup_details_for_host(module, client, server_id)
+            add_client_to_server(client, server_id, add_args)
+            backup_details = get_backup_details_for_host(client, server_id)
             backup_client = get_backup_client(backup_details, client_type)
-            server_clients_return[server_id] = \
-                _backup_client_obj_to_dict(backup_client)
+            if backup_client is None:
+                raise BackupClientError("Added client not found on host: %s"
+                                        % server_id)
+            result = _backup_client_obj_to_dict(backup_client)
         elif state == 'present' and backup_client is not None:
-            existing_service_plan = backup_details.sevice_plan
-            modify_backup_for_server(
-                client, module, server_id, existing_service_plan)
-            # needed? backup_details = get_backup_details_for_host(module, client, server_id)
-            server_clients_return[server_id] = \
-                _backup_client_obj_to_dict(backup_client)
+            existing_service_plan = getattr(backup_details, 'service_plan',
+                                            None)
+            if (service_plan is not None and
+                    service_plan != existing_service_plan):
+                changed = True
+                modify_backup_for_server(client, server_id, service_plan)
+            result = _backup_client_obj_to_dict(backup_client)
         else:
-            module.fail_json(msg="Unhandled state")
+            raise BackupClientError("Unhandled state")
+    except BackupClientError as e:
+        return server_id, changed, result, str(e)
+    except Exception as e:
+        return server_id, changed, result, \
+            "Unexpected error for host %s: %s" % (server_id, e)
+    return server_id, changed, result, None
+
+
+def handle_backup_client(module, get_client):
+    changed = False
+    params = module.params
+    state = params['state']
+    client_type = params['client_type']
+    service_plan = params.get('service_plan')
+    node_ids = params['node_ids']
+    batch_size = max(1, params['batch_size'])
+    add_args = (params.get('storage_policy'), params.get('schedule_policy'),
+                client_type, params['notify_trigger'], params['notify_email'])
+    server_clients_return = {}
+    errors = []
+
+    executor = None
+    if HAS_FUTURES and len(node_ids) > 1:
+        executor = ThreadPoolExecutor(
+            max_workers=min(MAX_WORKERS, len(node_ids), batch_size))
+
+    try:
+        for i in range(0, len(node_ids), batch_size):
+            batch = node_ids[i:i + batch_size]
+            if executor is not None:
+                futures = [executor.submit(_process_server, get_client,
+                                           server_id, state, client_type,
+                                           service_plan, add_args)
+                           for server_id in batch]
+                results = (future.result()
+                           for future in as_completed(futures))
+            else:
+                results = (_process_server(get_client, server_id, state,
+                                           client_type, service_plan,
+                                           add_args)
+                           for server_id in batch)
+
+            for server_id, server_changed, result, error in results:
+                changed |= server_changed
+                if result is not None:
+                    server_clients_return[server_id] = result
+                if error is not None:
+                    errors.append(error)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    if errors:
+        module.fail_json(msg='; '.join(errors), changed=changed,
+                         backups=server_clients_return)
 
     module.exit_json(changed=changed, msg='Success',
                      backups=server_clients_return)
 
 
-def remove_client_from_server(client, module, server_id, backup_client):
+def remove_client_from_server(client, server_id, backup_client):
     try:
-        client.ex_remove_client_from_target(server_id, backup_client)
+        _call_with_retry(client, client.ex_remove_client_from_target,
+                         server_id, backup_client)
     except DimensionDataAPIException as e:
-        module.fail_json(msg="Failed removing client from host: %s" % e.msg)
-
+        raise BackupClientError("Failed removing client from host: %s"
+                                % e.msg)
+    finally:
+        invalidate_backup_details(client, server_id)
 
-def add_client_to_server(client, module, server_id):
-    def getkeyordie(k):
-        v = module.params[k]
-        if v is None:
-            module.fail_json(msg='Need key %s for adding a client' % k)
-        return v
 
-    storage_policy = getkeyordie('storage_policy')
-    schedule_policy = getkeyordie('schedule_policy')
-    client_type = getkeyordie('client_type')
-    trigger = module.params['notify_trigger']
-    notify_email = module.params['notify_email']
+def add_client_to_server(client, server_id, add_args):
+    """
+    add_args is the pre-validated tuple of (storage_policy, schedule_policy,
+    client_type, trigger, notify_email).
+    """
+    storage_policy, schedule_policy, client_type, trigger, notify_email = \
+        add_args
 
     try:
-        backup_client = client.ex_add_client_to_target(
-            server_id, client_type, storage_policy,
-            schedule_policy, trigger, notify_email
+        _call_with_retry(
+            client, client.ex_add_client_to_target, server_id, client_type,
+            storage_policy, schedule_policy, trigger, notify_email
         )
     except DimensionDataAPIException as e:
-        module.fail_json(msg="Failed adding client to host: %s" % e.msg)
-    return backup_client
+        raise BackupClientError("Failed adding client to host: %s" % e.msg)
+    finally:
+        invalidate_backup_details(client, server_id)
 
 
-def modify_backup_for_server(client, module, server_id, service_plan):
+def modify_backup_for_server(client, server_id, service_plan):
     extra = {'servicePlan': service_plan}
-    client.update_target(server_id, extra=extra)
-
-
-def _storage_policy_choices():
-    storage_policy_lengths = ['14 Day', '30 Day', '60 Day', '90 Day',
-                              '180 Day', '1 Year', '2 Year', '3 Year',
-                              '4 Year', '5 Year', '6 Year', '7 Year']
-    storage_policy_choices = []
-    for storage_policy_length in storage_policy_lengths:
-        storage_policy_choices.append(
-            "%s Storage Policy" % storage_policy_length
-        )
-        storage_policy_choices.append(
-            "%s Storage Policy + Secondary Copy" % storage_policy_length
-        )
-    return storage_policy_choices
+    try:
+        _call_with_retry(client, client.update_target, server_id,
+                         extra=extra)
+    except DimensionDataAPIException as e:
+        raise BackupClientError("Failed modifying backup for host: %s"
+                                % e.msg)
+    finally:
+        invalidate_backup_details(client, server_id)
 
 
 def main():
@@ -261,20 +675,36 @@ def main():
             state=dict(default='present', choices=['present', 'absent']),
             node_ids=dict(required=True, type='list',
                           aliases=['server_id', 'server_ids', 'node_id']),
-            client_type=dict(required=True,
-                             choices=['FA.Win', 'FA.AD', 'FA.Linux',
-                                      'MySQL', 'PostgreSQL']),
-            schedule_policy=dict(choices=['12AM - 6AM', '6AM - 12PM',
-                                          '12PM - 6PM', '6PM - 12AM']),
-            storage_policy=dict(choices=_storage_policy_choices()),
+            client_type=dict(required=True, choices=_CLIENT_TYPES),
+            schedule_policy=dict(choices=_SCHEDULE_POLICIES),
+            storage_policy=dict(choices=_STORAGE_POLICY_CHOICES),
             notify_email=dict(required=False, default='nobody@example.com'),
             notify_trigger=dict(required=False, default='ON_FAILURE',
-                                choices=['ON_FAILURE', 'ON_SUCCESS']),
+                                choices=_NOTIFY_TRIGGERS),
+            service_plan=dict(required=False, default=None,
+                              choices=_SERVICE_PLANS),
+            cache_dir=dict(required=False,
+                           default='~/.ansible/tmp/dd_backup_cache'),
+            cache_ttl=dict(required=False, default=60, type='int'),
+            api_rate_limit=dict(required=False, default=20, type='float'),
+            api_burst=dict(required=False, default=40, type='int'),
+            batch_size=dict(required=False, default=50, type='int'),
             verify_ssl_cert=dict(required=False, default=True, type='bool'),
-        )
+        ),
+        required_if=[
+            ('state', 'present', ['storage_policy', 'schedule_policy'])],
     )
-    if not HAS_LIBCLOUD:
-        module.fail_json(msg='libcloud is required for this module.')
+    # libcloud is imported here rather than at module level so its cost is
+    # only paid when the module actually runs. DimensionDataAPIException
+    # replaces the module-level placeholder for the helpers that catch it.
+    global DimensionDataAPIException
+    try:
+        from libcloud.common.dimensiondata import DimensionDataAPIException
+        from libcloud.backup.drivers.dimensiondata import \
+            DimensionDataBackupDriver
+        import libcloud.security
+    except ImportError as e:
+        module.fail_json(msg='libcloud is required for this module: %s' % e)
 
     # set short vars for readability
     credentials = get_credentials()
@@ -284,11 +714,31 @@ def main():
     key = credentials['key']
     region = 'dd-%s' % module.params['region']
     verify_ssl_cert = module.params['verify_ssl_cert']
-    # Instantiate driver
     libcloud.security.VERIFY_SSL_CERT = verify_ssl_cert
-    client = DimensionDataBackupDriver(user_id, key, region=region)
 
-    handle_backup_client(module, client)
+    # libcloud connections are not thread-safe, so every worker thread gets
+    # its own driver. The caches and the rate limiter are shared.
+    bd_cache = {}
+    disk_cache = BackupDetailsCache(
+        module.params['cache_dir'], module.params['cache_ttl'],
+        region, user_id)
+    rate_limiter = None
+    if module.params['api_rate_limit'] > 0:
+        rate_limiter = TokenBucket(module.params['api_rate_limit'],
+                                   module.params['api_burst'])
+    local = threading.local()
+
+    def get_client():
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = DimensionDataBackupDriver(user_id, key, region=region)
+            client._bd_cache = bd_cache
+            client._bd_disk_cache = disk_cache
+            client._rate_limiter = rate_limiter
+            local.client = client
+        return client
+
+    handle_backup_client(module, get_client)
 
 if __name__ == '__main__':
         main()
@@ -0,0 +1,486 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from libcloud.common.dimensiondata import (
+    DimensionDataBackupClient, DimensionDataBackupClientAlert,
+    DimensionDataBackupClientRunningJob, DimensionDataBackupClientType,
+    DimensionDataBackupDetails)
+
+import cloud.dimensiondata.dimensiondata_backup_client as backup_client
+
+
+class FakeAPIException(Exception):
+
+    def __init__(self, code, msg):
+        super(FakeAPIException, self).__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeCondition(object):
+    """Condition whose wait() advances a fake clock instead of blocking."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.waits = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def wait(self, timeout):
+        self.waits.append(timeout)
+        self.clock.now += timeout
+
+
+class FakeModule(object):
+
+    class Exit(Exception):
+        pass
+
+    def __init__(self, params):
+        self.params = params
+        self.result = None
+
+    def exit_json(self, **kwargs):
+        self.result = kwargs
+        raise self.Exit()
+
+    def fail_json(self, **kwargs):
+        kwargs['failed'] = True
+        self.result = kwargs
+        raise self.Exit()
+
+
+class FakeClientType(object):
+
+    def __init__(self, type):
+        self.type = type
+
+
+class FakeBackupClient(object):
+
+    def __init__(self, client_type):
+        self.id = 'client-%s' % client_type
+        self.type = FakeClientType(client_type)
+        self.storage_policy = '14 Day Storage Policy'
+        self.schedule_policy = '12AM - 6AM'
+        self.download_url = 'https://example.com/agent'
+
+
+class FakeBackupDetails(object):
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.service_plan = 'Essentials'
+
+
+class FakeDriver(object):
+
+    def __init__(self, existing=(), broken=()):
+        self.existing = set(existing)
+        self.broken = set(broken)
+        self.calls = []
+
+    def ex_get_backup_details_for_target(self, server_id):
+        self.calls.append(('get', server_id))
+        if server_id in self.broken:
+            raise ValueError('connection reset')
+        clients = []
+        if server_id in self.existing:
+            clients.append(FakeBackupClient('FA.Linux'))
+        return FakeBackupDetails(clients)
+
+    def ex_add_client_to_target(self, server_id, *args):
+        self.calls.append(('add', server_id))
+        self.existing.add(server_id)
+        return True
+
+    def update_target(self, server_id, extra=None):
+        self.calls.append(('update', server_id, extra))
+        return True
+
+    def ex_remove_client_from_target(self, server_id, backup_client):
+        self.calls.append(('remove', server_id))
+        self.existing.discard(server_id)
+        return True
+
+
+def make_backup_details(asset_id='asset-1'):
+    client = DimensionDataBackupClient(
+        id='client-1',
+        type=DimensionDataBackupClientType('FA.Linux', True, 'Linux agent'),
+        status='ACTIVE',
+        schedule_policy='12AM - 6AM',
+        storage_policy='14 Day Storage Policy',
+        download_url='https://example.com/agent',
+        alert=DimensionDataBackupClientAlert('ON_FAILURE',
+                                             ['nobody@example.com']),
+        running_job=DimensionDataBackupClientRunningJob('job-1', 'RUNNING',
+                                                        50))
+    return DimensionDataBackupDetails(asset_id, 'Essentials', 'NORMAL',
+                                      [client])
+
+
+def module_params(**kwargs):
+    params = dict(
+        state='present',
+        client_type='FA.Linux',
+        node_ids=[],
+        storage_policy='14 Day Storage Policy',
+        schedule_policy='12AM - 6AM',
+        notify_trigger='ON_FAILURE',
+        notify_email='nobody@example.com',
+        service_plan=None,
+        batch_size=50,
+    )
+    params.update(kwargs)
+    return params
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(backup_client, '_monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_bucket(self, rate, burst):
+        bucket = backup_client.TokenBucket(rate, burst)
+        bucket.cond = FakeCondition(self.clock)
+        return bucket
+
+    def test_burst_is_available_immediately(self):
+        bucket = self.make_bucket(10, 3)
+        for i in range(3):
+            bucket.acquire()
+        self.assertEqual(bucket.cond.waits, [])
+        self.assertEqual(self.clock.now, 0.0)
+
+    def test_acquire_waits_for_refill_when_drained(self):
+        bucket = self.make_bucket(4, 1)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(bucket.cond.waits, [0.25])
+        self.assertAlmostEqual(self.clock.now, 0.25)
+
+    def test_throttle_only_when_drained(self):
+        bucket = self.make_bucket(10, 2)
+        self.assertFalse(bucket.throttle())
+        self.assertEqual(bucket.rate, 10)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertTrue(bucket.throttle())
+        self.assertEqual(bucket.rate, 5)
+
+    def test_throttle_once_per_refill_interval(self):
+        bucket = self.make_bucket(10, 1)
+        bucket.acquire()
+        self.assertTrue(bucket.throttle())
+        for i in range(15):
+            self.assertFalse(bucket.throttle())
+        self.assertEqual(bucket.rate, 5)
+
+    def test_throttle_never_raises_rate(self):
+        bucket = self.make_bucket(0.5, 1)
+        bucket.acquire()
+        self.assertTrue(bucket.throttle())
+        self.assertEqual(bucket.rate, 0.5)
+
+    def test_throttle_stops_at_floor(self):
+        bucket = self.make_bucket(3, 1)
+        bucket.acquire()
+        bucket.throttle()
+        self.assertEqual(bucket.rate, 1.5)
+        self.clock.now += 1
+        bucket.acquire()
+        bucket.acquire()
+        bucket.throttle()
+        self.assertEqual(bucket.rate, backup_client.MIN_API_RATE)
+
+
+class CallWithRetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(backup_client, 'DimensionDataAPIException',
+                              FakeAPIException),
+            mock.patch.object(backup_client.random, 'uniform',
+                              return_value=0),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(backup_client.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock(_rate_limiter=None)
+
+    def test_retries_rate_limited_calls_with_backoff(self):
+        fn = mock.Mock(side_effect=[FakeAPIException('429', 'slow down'),
+                                    FakeAPIException('BUSY', 'Rate limit'),
+                                    'ok'])
+        self.assertEqual(
+            backup_client._call_with_retry(self.client, fn, 'a', b='c'), 'ok')
+        self.assertEqual(fn.call_count, 3)
+        fn.assert_called_with('a', b='c')
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list],
+                         [0.5, 1.0])
+
+    def test_retries_transient_server_errors_without_throttling(self):
+        limiter = mock.Mock()
+        self.client._rate_limiter = limiter
+        fn = mock.Mock(side_effect=[FakeAPIException(503, 'Unavailable'),
+                                    FakeAPIException(502, 'Bad Gateway'),
+                                    FakeAPIException(504, 'Timeout'),
+                                    'ok'])
+        self.assertEqual(backup_client._call_with_retry(self.client, fn),
+                         'ok')
+        self.assertEqual(fn.call_count, 4)
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list],
+                         [0.5, 1.0, 2.0])
+        self.assertEqual(limiter.acquire.call_count, 4)
+        self.assertFalse(limiter.throttle.called)
+
+    def test_daily_limit_doubles_delay(self):
+        fn = mock.Mock(side_effect=[
+            FakeAPIException('429', 'daily rate limit exceeded'), 'ok'])
+        backup_client._call_with_retry(self.client, fn)
+        self.sleep.assert_called_once_with(1.0)
+
+    def test_other_errors_are_not_retried(self):
+        fn = mock.Mock(side_effect=FakeAPIException('NOT_FOUND', 'gone'))
+        self.assertRaises(FakeAPIException,
+                          backup_client._call_with_retry, self.client, fn)
+        self.assertEqual(fn.call_count, 1)
+        self.assertFalse(self.sleep.called)
+
+    def test_gives_up_after_max_attempts(self):
+        fn = mock.Mock(side_effect=FakeAPIException('429', 'slow down'))
+        self.assertRaises(FakeAPIException,
+                          backup_client._call_with_retry, self.client, fn)
+        self.assertEqual(fn.call_count, backup_client.RETRY_ATTEMPTS)
+
+    def test_uses_rate_limiter(self):
+        limiter = mock.Mock()
+        self.client._rate_limiter = limiter
+        fn = mock.Mock(side_effect=[FakeAPIException('429', 'slow down'),
+                                    'ok'])
+        backup_client._call_with_retry(self.client, fn)
+        self.assertEqual(limiter.acquire.call_count, 2)
+        limiter.throttle.assert_called_once_with()
+
+
+class HandleBackupClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(backup_client,
+                                    'DimensionDataAPIException',
+                                    FakeAPIException)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_module(self, driver, **params):
+        module = FakeModule(module_params(**params))
+        try:
+            backup_client.handle_backup_client(module, lambda: driver)
+        except FakeModule.Exit:
+            pass
+        return module.result
+
+    def test_batches_process_every_node(self):
+        for has_futures in (True, False):
+            driver = FakeDriver(existing=['n1', 'n4'])
+            with mock.patch.object(backup_client, 'HAS_FUTURES',
+                                   has_futures):
+                result = self.run_module(
+                    driver, node_ids=['n1', 'n2', 'n3', 'n4', 'n5'],
+                    batch_size=2)
+            self.assertTrue(result['changed'])
+            self.assertFalse(result.get('failed', False))
+            self.assertEqual(sorted(result['backups']),
+                             ['n1', 'n2', 'n3', 'n4', 'n5'])
+            self.assertEqual(sorted(c[1] for c in driver.calls
+                                    if c[0] == 'add'),
+                             ['n2', 'n3', 'n5'])
+
+    def test_batches_are_submitted_in_order(self):
+        submitted = []
+        driver = FakeDriver(existing=['n1', 'n2', 'n3'])
+
+        def process(get_client, server_id, *args):
+            submitted.append(server_id)
+            return server_id, False, None, None
+
+        with mock.patch.object(backup_client, '_process_server', process):
+            with mock.patch.object(backup_client, 'HAS_FUTURES', False):
+                self.run_module(driver, node_ids=['n1', 'n2', 'n3'],
+                                batch_size=2)
+        self.assertEqual(submitted, ['n1', 'n2', 'n3'])
+
+    def test_existing_client_service_plan(self):
+        for service_plan, changed in (('Advanced', True),
+                                      ('Essentials', False),
+                                      (None, False)):
+            driver = FakeDriver(existing=['n1'])
+            result = self.run_module(driver, node_ids=['n1'],
+                                     service_plan=service_plan)
+            self.assertEqual(result['changed'], changed)
+            self.assertEqual(list(result['backups']), ['n1'])
+            updates = [c for c in driver.calls if c[0] == 'update']
+            if changed:
+                self.assertEqual(
+                    updates,
+                    [('update', 'n1', {'servicePlan': service_plan})])
+            else:
+                self.assertEqual(updates, [])
+
+    def test_unexpected_errors_are_reported_once(self):
+        driver = FakeDriver(broken=['n2'])
+        result = self.run_module(driver, node_ids=['n1', 'n2', 'n3'],
+                                 batch_size=2)
+        self.assertTrue(result['failed'])
+        self.assertTrue(result['changed'])
+        self.assertIn('n2', result['msg'])
+        self.assertEqual(sorted(result['backups']), ['n1', 'n3'])
+
+
+class BackupDetailsCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        patcher = mock.patch.object(backup_client.time, 'time',
+                                    return_value=1000.0)
+        self.time = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = self.make_cache()
+
+    def make_cache(self, ttl=60, user_id='user'):
+        return backup_client.BackupDetailsCache(self.cache_dir, ttl,
+                                                'dd-na', user_id)
+
+    def test_round_trip(self):
+        self.cache.set('n1', make_backup_details())
+        details = self.cache.get('n1')
+        self.assertTrue(isinstance(details, DimensionDataBackupDetails))
+        self.assertEqual(details.asset_id, 'asset-1')
+        self.assertEqual(details.service_plan, 'Essentials')
+        self.assertEqual(details.status, 'NORMAL')
+        self.assertEqual(len(details.clients), 1)
+        client = details.clients[0]
+        self.assertTrue(isinstance(client, DimensionDataBackupClient))
+        self.assertEqual(client.id, 'client-1')
+        self.assertEqual(client.type.type, 'FA.Linux')
+        self.assertTrue(client.type.is_file_system)
+        self.assertEqual(client.type.description, 'Linux agent')
+        self.assertEqual(client.status, 'ACTIVE')
+        self.assertEqual(client.schedule_policy, '12AM - 6AM')
+        self.assertEqual(client.storage_policy, '14 Day Storage Policy')
+        self.assertEqual(client.download_url, 'https://example.com/agent')
+        self.assertEqual(client.alert.trigger, 'ON_FAILURE')
+        self.assertEqual(client.alert.notify_list, ['nobody@example.com'])
+        self.assertEqual(client.running_job.id, 'job-1')
+        self.assertEqual(client.running_job.status, 'RUNNING')
+        self.assertEqual(client.running_job.percentage, 50)
+
+    def test_round_trip_without_alert_or_running_job(self):
+        details = make_backup_details()
+        details.clients[0].alert = None
+        details.clients[0].running_job = None
+        self.cache.set('n1', details)
+        client = self.cache.get('n1').clients[0]
+        self.assertEqual(client.alert, None)
+        self.assertEqual(client.running_job, None)
+
+    def test_keys_do_not_collide(self):
+        self.make_cache(user_id='ab').set('1', make_backup_details())
+        self.assertEqual(self.make_cache(user_id='a').get('b1'), None)
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.set('n1', make_backup_details())
+        self.time.return_value = 1060.0
+        self.assertNotEqual(self.cache.get('n1'), None)
+        self.time.return_value = 1060.5
+        self.assertEqual(self.cache.get('n1'), None)
+
+    def test_zero_ttl_disables_cache(self):
+        cache = self.make_cache(ttl=0)
+        cache.set('n1', make_backup_details())
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual(cache.get('n1'), None)
+
+    def test_corrupt_entry_is_a_miss(self):
+        self.cache.set('n1', make_backup_details())
+        with open(self.cache._path('n1'), 'w') as f:
+            f.write('not json')
+        self.assertEqual(self.cache.get('n1'), None)
+
+    def test_invalidate(self):
+        self.cache.set('n1', make_backup_details())
+        self.cache.invalidate('n1')
+        self.assertEqual(self.cache.get('n1'), None)
+        self.cache.invalidate('n1')
+
+    def test_mutations_invalidate_cached_details(self):
+        add_args = ('14 Day Storage Policy', '12AM - 6AM', 'FA.Linux',
+                    'ON_FAILURE', 'nobody@example.com')
+        mutations = [
+            lambda driver: backup_client.add_client_to_server(
+                driver, 'n1', add_args),
+            lambda driver: backup_client.remove_client_from_server(
+                driver, 'n1', 'client-1'),
+            lambda driver: backup_client.modify_backup_for_server(
+                driver, 'n1', 'Advanced'),
+        ]
+        for mutate in mutations:
+            driver = FakeDriver(existing=['n1'])
+            driver._bd_disk_cache = self.cache
+            driver._rate_limiter = None
+            self.cache.set('n1', make_backup_details())
+            backup_client.get_backup_details_for_host(driver, 'n1')
+            mutate(driver)
+            self.assertEqual(self.cache.get('n1'), None)
+            self.assertNotIn('n1', driver._bd_cache)
+
+    def test_get_backup_details_for_host_prefers_disk_cache(self):
+        driver = FakeDriver(existing=['n1'])
+        driver._bd_disk_cache = self.cache
+        self.cache.set('n1', make_backup_details(asset_id='cached'))
+        details = backup_client.get_backup_details_for_host(driver, 'n1')
+        self.assertEqual(details.asset_id, 'cached')
+        self.assertEqual(driver.calls, [])
+
+    def test_get_backup_details_for_host_writes_back_on_miss(self):
+        driver = mock.Mock(_rate_limiter=None, _bd_disk_cache=self.cache)
+        driver.ex_get_backup_details_for_target.return_value = \
+            make_backup_details(asset_id='fetched')
+        details = backup_client.get_backup_details_for_host(driver, 'n1')
+        self.assertEqual(details.asset_id, 'fetched')
+        self.assertEqual(self.cache.get('n1').asset_id, 'fetched')
+        driver.ex_get_backup_details_for_target.assert_called_once_with('n1')
+
+
+if __name__ == '__main__':
+    unittest.main()